@@ -27,6 +27,8 @@ from functools import wraps
 from loguru import logger
 import subprocess
 import re
+import hashlib
+from collections import OrderedDict
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -49,6 +51,8 @@ MAX_RESTART_ATTEMPTS = 5
 SYNC_INTERVAL = 30 * 24 * 3600  # 30 дней
 CLEAN_VIOLATIONS_INTERVAL = 50 * 24 * 3600
 REQUEST_TIMEOUT = 120
+VERDICT_CACHE_SIZE = 2048
+MESSAGE_VERSIONS_LIMIT = 5000
 
 # Лимиты для rate limiting
 RATE_LIMITS = {
@@ -383,56 +387,110 @@ async def night_auto_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     await update.message.reply_text(response, parse_mode="HTML", reply_markup=keyboard)
     await context.bot.send_message(chat_id=OWNER_ID, text=f"🔔 Ночное сообщение от {user_name} (ID: {user_id}): {text}", parse_mode="HTML")
 
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+def find_bad_word(text: str) -> Optional[str]:
+    for match in BAD_WORDS_PATTERN.finditer(text):
+        word = match.group(0)
+        if len(word) < 3 or any(c.isdigit() for c in word) or word in ["бла", "суп", "пика"]:
+            continue
+        return word
+    return None
+
+def classify_text(text: str, context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
+    # Вердикт кэшируется по хэшу нормализованного текста (LRU)
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    cache = context.bot_data.setdefault('verdict_cache', OrderedDict())
+    if digest in cache:
+        cache.move_to_end(digest)
+        return cache[digest]
+    verdict = find_bad_word(text)
+    cache[digest] = verdict
+    if len(cache) > VERDICT_CACHE_SIZE:
+        cache.popitem(last=False)
+    return verdict
+
+def track_message_version(chat_id: int, message_id: int, version: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    # Возвращает False, если уже получена более новая версия сообщения
+    versions = context.bot_data.setdefault('message_versions', OrderedDict())
+    key = (chat_id, message_id)
+    entry = versions.setdefault(key, {"version": version, "penalized": False})
+    if entry["version"] > version:
+        return False
+    entry["version"] = version
+    versions.move_to_end(key)
+    if len(versions) > MESSAGE_VERSIONS_LIMIT:
+        versions.popitem(last=False)
+    return True
+
+def is_current_version(chat_id: int, message_id: int, version: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    entry = context.bot_data.get('message_versions', {}).get((chat_id, message_id))
+    return entry is None or entry["version"] <= version
+
 async def check_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if update.message.chat_id != GROUP_ID or not update.message.text or is_admin(update.effective_user.id):
+    message = update.effective_message
+    if not message or message.chat_id != GROUP_ID or not update.effective_user or is_admin(update.effective_user.id):
         return
-    text = update.message.text.lower()
+    # update_id растёт монотонно, поэтому любая правка (даже укороченная) делает прежний вердикт устаревшим
+    version = update.update_id
+    if not track_message_version(message.chat_id, message.message_id, version, context):
+        return
+    raw_text = message.text or message.caption
+    if not raw_text:
+        return
+    text = normalize_text(raw_text)
     if len(text) < MIN_MESSAGE_LENGTH:
         return
 
-    current_date = get_current_time().date()
-    if current_date != context.bot_data.get('last_day_reset'):
-        context.bot_data['messages_today'] = 0
-        context.bot_data['last_day_reset'] = current_date
-    context.bot_data['messages_processed'] = context.bot_data.get('messages_processed', 0) + 1
-    context.bot_data['messages_today'] = context.bot_data.get('messages_today', 0) + 1
+    if update.message is not None:
+        current_date = get_current_time().date()
+        if current_date != context.bot_data.get('last_day_reset'):
+            context.bot_data['messages_today'] = 0
+            context.bot_data['last_day_reset'] = current_date
+        context.bot_data['messages_processed'] = context.bot_data.get('messages_processed', 0) + 1
+        context.bot_data['messages_today'] = context.bot_data.get('messages_today', 0) + 1
 
-    matches = list(BAD_WORDS_PATTERN.finditer(text))
-    if not matches:
+    word = classify_text(text, context)
+    if not word:
         return
 
-    for match in matches:
-        word = match.group(0)
-        if len(word) < 3 or any(c.isdigit() for c in word) or word in ["бла", "суп", "пика"]:
-            continue
+    bot_rights = await get_bot_rights(context)
+    # Пока ждали ответ API, сообщение могли исправить — устаревший вердикт не применяем
+    if not is_current_version(message.chat_id, message.message_id, version, context):
+        return
+    # За одно сообщение — одно предупреждение, сколько бы раз его ни правили
+    entry = context.bot_data['message_versions'].get((message.chat_id, message.message_id))
+    if entry is not None:
+        if entry["penalized"]:
+            return
+        entry["penalized"] = True
 
-        user_id = update.effective_user.id
-        now = get_current_time()
-        violation_data = await get_violations(user_id, context)
-        count = 0 if not violation_data["last_violation"] or (now - violation_data["last_violation"]) > timedelta(hours=VIOLATION_TIMEOUT_HOURS) else violation_data["count"]
-        count += 1
-        await update_violations(user_id, count, now, context)
-
-        bot_rights = await get_bot_rights(context)
-        if bot_rights.can_delete_messages:
-            await update.message.delete()
-        remaining_lives = MAX_VIOLATIONS - count
-        keyboard = create_subscribe_keyboard()
+    user_id = update.effective_user.id
+    now = get_current_time()
+    violation_data = await get_violations(user_id, context)
+    count = 0 if not violation_data["last_violation"] or (now - violation_data["last_violation"]) > timedelta(hours=VIOLATION_TIMEOUT_HOURS) else violation_data["count"]
+    count += 1
+    await update_violations(user_id, count, now, context)
+
+    if bot_rights.can_delete_messages:
+        await message.delete()
+    remaining_lives = MAX_VIOLATIONS - count
+    keyboard = create_subscribe_keyboard()
+    await context.bot.send_message(
+        chat_id=GROUP_ID,
+        text=f"⚠️ Нарушение правил! Слово: '{word}'. Осталось предупреждений: {remaining_lives}",
+        parse_mode="HTML",
+        reply_markup=keyboard
+    )
+    if count >= MAX_VIOLATIONS and bot_rights.can_restrict_members:
+        await context.bot.ban_chat_member(GROUP_ID, user_id)
+        context.bot_data.setdefault('banned_users', set()).add(user_id)
         await context.bot.send_message(
             chat_id=GROUP_ID,
-            text=f"⚠️ Нарушение правил! Слово: '{word}'. Осталось предупреждений: {remaining_lives}",
-            parse_mode="HTML",
+            text="🚫 Пользователь заблокирован.",
             reply_markup=keyboard
         )
-        if count >= MAX_VIOLATIONS and bot_rights.can_restrict_members:
-            await context.bot.ban_chat_member(GROUP_ID, user_id)
-            context.bot_data.setdefault('banned_users', set()).add(user_id)
-            await context.bot.send_message(
-                chat_id=GROUP_ID,
-                text="🚫 Пользователь заблокирован.",
-                reply_markup=keyboard
-            )
-        break
 
 @rate_limit("rules")
 async def show_rules(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -569,6 +627,8 @@ async def run_bot(application: Application) -> None:
     application.bot_data['violations_cache'] = {}
     application.bot_data['subscriptions_cache'] = {}
     application.bot_data['banned_users'] = set()
+    application.bot_data['verdict_cache'] = OrderedDict()
+    application.bot_data['message_versions'] = OrderedDict()
 
     application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, welcome_new_member))
     application.add_handler(CommandHandler("rules", show_rules))
@@ -577,8 +637,8 @@ async def run_bot(application: Application) -> None:
     application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("restart", restart_command))
     application.add_handler(CommandHandler("status", status_command))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.Chat(GROUP_ID), check_message))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.Chat(GROUP_ID), night_auto_reply))
+    application.add_handler(MessageHandler(filters.UpdateType.MESSAGES & (filters.TEXT | filters.CAPTION) & ~filters.COMMAND & filters.Chat(GROUP_ID), check_message))
+    application.add_handler(MessageHandler(filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND & filters.Chat(GROUP_ID), night_auto_reply))
     application.add_handler(CallbackQueryHandler(welcome_read_button, pattern="^welcome_read$"))
     application.add_handler(ConversationHandler(
         entry_points=[CommandHandler("start", start)],